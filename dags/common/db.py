@@ -0,0 +1,167 @@
+"""
+Shared Postgres access for all DAG tasks and scripts
+
+Connection settings come from the Airflow connection named by
+DOTA2_POSTGRES_CONN_ID (default 'dota2_postgres') when it exists,
+otherwise from POSTGRES_* env vars (defaults match docker-compose).
+
+- One connection pool per process (POSTGRES_POOL_MIN / POSTGRES_POOL_MAX)
+- statement_timeout on every connection (POSTGRES_STATEMENT_TIMEOUT_MS)
+- Hot queries run as server-side prepared statements (PREPARE / EXECUTE)
+- POSTGRES_PGBOUNCER=true for PgBouncer transaction pooling: no session
+  state, so the timeout is applied with SET LOCAL per transaction and
+  prepared statements fall back to plain execute
+"""
+
+import logging
+import os
+import re
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from common.profiling import phase
+
+POOL_MIN = int(os.environ.get('POSTGRES_POOL_MIN', '1'))
+POOL_MAX = int(os.environ.get('POSTGRES_POOL_MAX', '4'))
+STATEMENT_TIMEOUT_MS = int(os.environ.get('POSTGRES_STATEMENT_TIMEOUT_MS', '300000'))
+PGBOUNCER_MODE = os.environ.get('POSTGRES_PGBOUNCER', 'false').lower() in ('1', 'true', 'yes')
+
+_pool = None
+_pool_pid = None
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Connection that remembers which statements were prepared on it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def _connection_params():
+    """Airflow connection if configured, else environment variables"""
+    conn_id = os.environ.get('DOTA2_POSTGRES_CONN_ID', 'dota2_postgres')
+    try:
+        from airflow.exceptions import AirflowNotFoundException
+        from airflow.hooks.base import BaseHook
+    except ImportError:
+        pass
+    else:
+        try:
+            conn = BaseHook.get_connection(conn_id)
+            return {
+                'host': conn.host,
+                'port': conn.port or 5432,
+                'database': conn.schema,
+                'user': conn.login,
+                'password': conn.password,
+            }
+        except AirflowNotFoundException:
+            pass
+
+    return {
+        'host': os.environ.get('POSTGRES_HOST', 'postgres'),
+        'port': int(os.environ.get('POSTGRES_PORT', '5432')),
+        'database': os.environ.get('POSTGRES_DB', 'airflow'),
+        'user': os.environ.get('POSTGRES_USER', 'airflow'),
+        'password': os.environ.get('POSTGRES_PASSWORD', 'airflow'),
+    }
+
+def _connect_kwargs():
+    params = _connection_params()
+    if not PGBOUNCER_MODE:
+        # PgBouncer rejects startup options, so only set it for direct connections
+        params['options'] = f'-c statement_timeout={STATEMENT_TIMEOUT_MS}'
+    return params
+
+def get_pool():
+    """Lazily create the pool (again after a fork, e.g. LocalExecutor tasks)"""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = psycopg2.pool.ThreadedConnectionPool(
+            POOL_MIN,
+            POOL_MAX,
+            connection_factory=PreparedConnection,
+            **_connect_kwargs()
+        )
+        _pool_pid = os.getpid()
+        logging.info(f"Postgres pool created (min={POOL_MIN}, max={POOL_MAX}, pgbouncer={PGBOUNCER_MODE})")
+    return _pool
+
+def _begin(cursor):
+    if PGBOUNCER_MODE:
+        # Equivalent to SET LOCAL: dropped again at commit/rollback
+        cursor.execute("SELECT set_config('statement_timeout', %s, true)", (str(STATEMENT_TIMEOUT_MS),))
+
+@contextmanager
+def transaction():
+    """Borrow a pooled connection and yield a cursor in one transaction
+
+    Commits on success, rolls back on error, then returns the connection.
+    Use commit(cursor) for intermediate commits inside the block.
+    """
+    with phase('db_checkout'):
+        pool = get_pool()
+        conn = pool.getconn()
+    broken = False
+    try:
+        with conn.cursor() as cursor:
+            _begin(cursor)
+            yield cursor
+        with phase('db_commit'):
+            conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken or conn.closed != 0)
+
+def commit(cursor):
+    """Commit so far and keep going in a new transaction on the same connection"""
+    with phase('db_commit'):
+        cursor.connection.commit()
+    _begin(cursor)
+
+def _to_positional(sql):
+    """Turn psycopg2 %s placeholders into $1, $2, ... for PREPARE"""
+    counter = iter(range(1, sql.count('%s') + 1))
+    return re.sub(r'%s', lambda _: f'${next(counter)}', sql)
+
+def execute_prepared(cursor, name, sql, params):
+    """Execute a hot query as a server-side prepared statement
+
+    The statement is prepared once per pooled connection. In PgBouncer
+    mode consecutive transactions may land on different server
+    connections, so the query is executed directly instead.
+    """
+    with phase('db_execute'):
+        if PGBOUNCER_MODE:
+            cursor.execute(sql, params)
+            return
+
+        conn = cursor.connection
+        if name not in conn.prepared:
+            cursor.execute(f"PREPARE {name} AS {_to_positional(sql)}")
+            conn.prepared.add(name)
+        placeholders = ', '.join(['%s'] * len(params))
+        cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+
+def get_engine():
+    """SQLAlchemy engine (for pandas) using the same settings"""
+    from sqlalchemy import create_engine, event
+
+    engine = create_engine(
+        'postgresql+psycopg2://',
+        creator=lambda: psycopg2.connect(**_connect_kwargs()),
+        pool_size=POOL_MAX,
+        pool_pre_ping=True,
+    )
+    if PGBOUNCER_MODE:
+        @event.listens_for(engine, 'begin')
+        def _set_statement_timeout(conn):
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {STATEMENT_TIMEOUT_MS}")
+    return engine
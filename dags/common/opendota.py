@@ -0,0 +1,226 @@
+"""
+OpenDota request budget shared by all DAGs and scripts
+
+Every fetch path takes a token from one bucket stored in Postgres
+(ops.api_quota) before calling the API, so overlapping runs of
+ingest_match_details, refresh_metadata and load_metadata.py share the
+free-tier limit instead of each backing off on its own.
+
+- Token bucket refilled at OPENDOTA_REQUESTS_PER_MINUTE (default 60)
+- SELECT ... FOR UPDATE on the bucket row serializes acquire across processes
+  (own pooled transaction from common.db, separate from the caller's)
+- X-Rate-Limit-Remaining-Minute clamps the bucket to what the server reports
+- 429 blocks the bucket for everyone until Retry-After has passed
+- Low priority callers (metadata, backfill) keep a reserve free for ingest
+"""
+
+import email.utils
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import requests
+
+from common.db import execute_prepared, transaction
+from common.profiling import phase
+
+PRIORITY_HIGH = 0  # incremental ingest
+PRIORITY_LOW = 1   # metadata refresh, backfill
+
+BUCKET_NAME = 'opendota'
+REQUESTS_PER_MINUTE = float(os.environ.get('OPENDOTA_REQUESTS_PER_MINUTE', '60'))
+BURST = float(os.environ.get('OPENDOTA_BURST', '5'))
+LOW_PRIORITY_RESERVE = float(os.environ.get('OPENDOTA_LOW_PRIORITY_RESERVE', '2'))
+
+# A rate of 0 would never refill. A burst below 1 or a reserve that needs
+# more tokens than the bucket holds would make acquire() wait forever.
+if REQUESTS_PER_MINUTE <= 0:
+    raise ValueError(f"OPENDOTA_REQUESTS_PER_MINUTE must be > 0, got {REQUESTS_PER_MINUTE}")
+if BURST < 1:
+    logging.warning(f"OPENDOTA_BURST={BURST} is below 1, using 1")
+    BURST = 1.0
+if not 0 <= LOW_PRIORITY_RESERVE <= BURST - 1:
+    clamped = min(max(LOW_PRIORITY_RESERVE, 0.0), BURST - 1)
+    logging.warning(f"OPENDOTA_LOW_PRIORITY_RESERVE={LOW_PRIORITY_RESERVE} must leave room for 1 token "
+                    f"in OPENDOTA_BURST={BURST}, using {clamped}")
+    LOW_PRIORITY_RESERVE = clamped
+
+DEFAULT_RETRY_AFTER = 60  # seconds, used when a 429 has no Retry-After
+MAX_SLEEP = 5  # re-check the bucket at least this often while waiting
+
+# Hot queries (run for every API call) -> prepared statements
+SELECT_BUCKET_SQL = """
+    SELECT tokens, capacity, refill_per_sec,
+           EXTRACT(EPOCH FROM clock_timestamp() - updated_at),
+           COALESCE(EXTRACT(EPOCH FROM blocked_until - clock_timestamp()), 0)
+    FROM ops.api_quota
+    WHERE name = %s
+    FOR UPDATE
+"""
+UPDATE_TOKENS_SQL = """
+    UPDATE ops.api_quota
+    SET tokens = %s, updated_at = clock_timestamp()
+    WHERE name = %s
+"""
+CLAMP_TOKENS_SQL = """
+    UPDATE ops.api_quota
+    SET tokens = LEAST(tokens, %s)
+    WHERE name = %s
+"""
+
+_bucket_ready = False
+
+@contextmanager
+def _quota_transaction():
+    """Own pooled transaction so quota commits never touch the caller's one"""
+    global _bucket_ready
+    if not _bucket_ready:
+        # Separate transaction: the flag is only set once the row is committed
+        with transaction() as cursor:
+            _ensure_bucket(cursor)
+        _bucket_ready = True
+    with transaction() as cursor:
+        yield cursor
+
+def _ensure_bucket(cursor):
+    """Create the quota table/row if missing and apply the current config"""
+    cursor.execute("CREATE SCHEMA IF NOT EXISTS ops")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ops.api_quota (
+            name VARCHAR(64) PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            capacity DOUBLE PRECISION NOT NULL,
+            refill_per_sec DOUBLE PRECISION NOT NULL,
+            blocked_until TIMESTAMPTZ,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO ops.api_quota (name, tokens, capacity, refill_per_sec)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (name) DO UPDATE
+        SET capacity = EXCLUDED.capacity,
+            refill_per_sec = EXCLUDED.refill_per_sec
+    """, (BUCKET_NAME, BURST, BURST, REQUESTS_PER_MINUTE / 60.0))
+
+def _try_acquire(priority):
+    """Take one token. Returns 0 on success, otherwise seconds to wait"""
+    with _quota_transaction() as cursor:
+        # Use the DB clock so all containers agree on elapsed time
+        execute_prepared(cursor, 'quota_lock_bucket', SELECT_BUCKET_SQL, (BUCKET_NAME,))
+        tokens, capacity, refill_per_sec, elapsed, blocked_for = cursor.fetchone()
+        
+        # Blocked after a 429: leave the row as observe() set it (tokens = 0,
+        # updated_at = blocked_until), so refill only starts once the block ends
+        if blocked_for > 0:
+            return float(blocked_for)
+        
+        tokens = min(capacity, tokens + max(0.0, float(elapsed)) * refill_per_sec)
+        
+        needed = 1.0
+        if priority != PRIORITY_HIGH:
+            needed += LOW_PRIORITY_RESERVE
+        
+        wait_time = 0.0
+        if tokens >= needed:
+            tokens -= 1.0
+        else:
+            wait_time = (needed - tokens) / refill_per_sec
+        
+        execute_prepared(cursor, 'quota_set_tokens', UPDATE_TOKENS_SQL, (tokens, BUCKET_NAME))
+    return wait_time
+
+def acquire(priority=PRIORITY_HIGH):
+    """Block until the shared budget allows one more request"""
+    while True:
+        wait_time = _try_acquire(priority)
+        if wait_time <= 0:
+            return
+        logging.info(f"OpenDota quota exhausted, waiting {wait_time:.1f}s (priority {priority})")
+        time.sleep(min(wait_time, MAX_SLEEP))
+
+def _parse_retry_after(value):
+    """Retry-After is either delta-seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def observe(response):
+    """Feed rate-limit information from a response back into the shared bucket"""
+    with _quota_transaction() as cursor:
+        if response.status_code == 429:
+            retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is None:
+                retry_after = DEFAULT_RETRY_AFTER
+            logging.warning(f"⚠️ Rate limited! Blocking all OpenDota callers for {retry_after:.0f}s")
+            cursor.execute("""
+                UPDATE ops.api_quota
+                SET tokens = 0,
+                    blocked_until = GREATEST(
+                        COALESCE(blocked_until, clock_timestamp()),
+                        clock_timestamp() + %s * INTERVAL '1 second'
+                    )
+                WHERE name = %s
+            """, (retry_after, BUCKET_NAME))
+            # Refill is measured from updated_at: start it when the block ends
+            cursor.execute("""
+                UPDATE ops.api_quota
+                SET updated_at = blocked_until
+                WHERE name = %s
+            """, (BUCKET_NAME,))
+            return
+        
+        remaining = response.headers.get('X-Rate-Limit-Remaining-Minute')
+        if remaining is None:
+            return
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return
+        # Other clients on the same IP may have spent part of the window
+        execute_prepared(cursor, 'quota_clamp_tokens', CLAMP_TOKENS_SQL, (remaining, BUCKET_NAME))
+
+def _is_retryable(error):
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500
+    return False
+
+def fetch_with_retry(url, params=None, priority=PRIORITY_HIGH, max_retries=3):
+    """Fetch URL through the shared OpenDota budget with retry logic"""
+    for attempt in range(max_retries):
+        with phase('quota_wait'):
+            acquire(priority)
+        try:
+            with phase('http'):
+                response = requests.get(url, params=params, timeout=30)
+            with phase('quota_observe'):
+                observe(response)
+            
+            # Handle rate limiting: the next acquire() waits out Retry-After
+            if response.status_code == 429:
+                continue
+            
+            response.raise_for_status()
+            return response
+            
+        except requests.exceptions.RequestException as e:
+            # Only transient failures are worth another token: timeouts,
+            # connection errors and 5xx. Other 4xx fail right away.
+            if not _is_retryable(e) or attempt == max_retries - 1:
+                raise
+            logging.warning(f"Request error: {e}, retrying in 10s...")
+            time.sleep(10)
+    
+    raise Exception(f"Max retries ({max_retries}) exceeded for {url}")
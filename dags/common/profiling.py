@@ -0,0 +1,227 @@
+"""
+Opt-in profiling for pipeline callables (stdlib only)
+
+Switched on by env PIPELINE_PROFILING=true or the Airflow Variable
+'pipeline_profiling'. When on, every @profiled callable writes to
+PIPELINE_PROFILE_DIR (default: profiles/ next to the export manifest):
+
+- <name>_<timestamp>.pstats     cProfile stats (python -m pstats, snakeviz)
+- <name>_<timestamp>.collapsed  sampled stacks, collapsed format (flamegraph.pl, speedscope)
+- <name>_<timestamp>.json       wall-clock per phase, tracemalloc peak and top allocations
+
+Mark phases with `with phase('db_fetch'):`. When profiling is off this
+is a no-op, so the markers stay in production code. Phase time is
+exclusive: a nested phase pauses its parent and is recorded under the
+parent's path (e.g. 'quota_wait/db_execute'), so phases never overlap
+and their sum stays within wall_seconds.
+"""
+
+import cProfile
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+AIRFLOW_EXPORT_DIR = '/opt/airflow/export'
+SAMPLE_INTERVAL = float(os.environ.get('PIPELINE_PROFILE_SAMPLE_INTERVAL', '0.005'))  # seconds
+TOP_ALLOCATIONS = 20
+
+_session = None
+
+def profiling_enabled():
+    """Env var wins if set, then the Airflow Variable (if Airflow is available)"""
+    value = os.environ.get('PIPELINE_PROFILING')
+    if not value:
+        try:
+            from airflow.models import Variable
+        except ImportError:
+            return False
+        value = Variable.get('pipeline_profiling', default_var='false')
+    return str(value).lower() in ('1', 'true', 'yes')
+
+class _StackSampler(threading.Thread):
+    """Samples one thread's stack at a fixed interval for flamegraphs
+
+    cProfile only records caller/callee pairs, so full stacks for the
+    collapsed output come from sampling instead.
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profiling-stack-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+class _ProfileSession:
+    """Everything collected during one profiled call"""
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = defaultdict(lambda: {'seconds': 0.0, 'calls': 0})
+        self.stack = []  # open phases: {'path', 'started', 'seconds'}
+        # Allocations are mostly freed by the end of the call, so keep the
+        # snapshot taken at the phase exit with the most memory in use
+        # (re-taken only on >10% growth, snapshots are not cheap)
+        self.snapshot = None
+        self.snapshot_phase = None
+        self.snapshot_bytes = 0
+
+    def enter(self, name):
+        now = time.perf_counter()
+        path = name
+        if self.stack:
+            parent = self.stack[-1]
+            parent['seconds'] += now - parent['started']
+            path = f"{parent['path']}/{name}"
+        self.stack.append({'path': path, 'started': now, 'seconds': 0.0})
+
+    def exit(self):
+        current = self.stack.pop()
+        self.add_phase(current['path'], current['seconds'] + time.perf_counter() - current['started'])
+        if self.stack:
+            # Resume the parent after bookkeeping (snapshots) is done
+            self.stack[-1]['started'] = time.perf_counter()
+
+    def add_phase(self, name, seconds):
+        self.phases[name]['seconds'] += seconds
+        self.phases[name]['calls'] += 1
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.snapshot_bytes * 1.1:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_phase = name
+            self.snapshot_bytes = current
+
+@contextmanager
+def phase(name):
+    """Accumulate exclusive wall-clock time spent in a named phase"""
+    session = _session
+    if session is None:
+        yield
+        return
+    session.enter(name)
+    try:
+        yield
+    finally:
+        session.exit()
+
+def _write_artifacts(session, output_dir, profiler, sampler, wall_seconds, status):
+    os.makedirs(output_dir, exist_ok=True)
+    base = os.path.join(output_dir, f"{session.name}_{datetime.now().strftime('%Y%m%dT%H%M%S')}")
+
+    profiler.dump_stats(f'{base}.pstats')
+
+    with open(f'{base}.collapsed', 'w') as f:
+        for stack, count in sampler.stacks.most_common():
+            f.write(f'{stack} {count}\n')
+
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = session.snapshot or tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, cProfile.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+    top = []
+    for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+        frame = stat.traceback[0]
+        top.append({
+            'location': f'{frame.filename}:{frame.lineno}',
+            'size_kb': round(stat.size / 1024, 1),
+            'count': stat.count,
+        })
+
+    summary = {
+        'callable': session.name,
+        'status': status,
+        'wall_seconds': round(wall_seconds, 3),
+        'phases': {
+            name: {'seconds': round(p['seconds'], 3), 'calls': p['calls']}
+            for name, p in sorted(session.phases.items(), key=lambda item: -item[1]['seconds'])
+        },
+        'tracemalloc': {
+            'current_mb': round(current / (1024 * 1024), 2),
+            'peak_mb': round(peak / (1024 * 1024), 2),
+            'top_allocations_after_phase': session.snapshot_phase,
+            'top_allocations': top,
+        },
+        'stack_samples': sum(sampler.stacks.values()),
+        'sample_interval_seconds': SAMPLE_INTERVAL,
+    }
+    with open(f'{base}.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    logging.info(f"📈 Profile written: {base}.pstats / .collapsed / .json")
+
+def profiled(name=None, output_dir=None):
+    """Decorator: profile the callable when profiling is switched on
+
+    output_dir defaults to PIPELINE_PROFILE_DIR, then <export dir>/profiles.
+    """
+    def decorator(func):
+        session_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            global _session
+            # Nested profiled calls are covered by the outer session
+            if _session is not None or not profiling_enabled():
+                return func(*args, **kwargs)
+
+            target_dir = os.environ.get('PIPELINE_PROFILE_DIR') or output_dir or os.path.join(AIRFLOW_EXPORT_DIR, 'profiles')
+            session = _ProfileSession(session_name)
+            profiler = cProfile.Profile()
+            sampler = _StackSampler(threading.get_ident(), SAMPLE_INTERVAL)
+            started_tracemalloc = not tracemalloc.is_tracing()
+            if started_tracemalloc:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+            logging.info(f"📈 Profiling {session_name} (artifacts -> {target_dir})")
+            _session = session
+            status = 'failed'
+            started = time.perf_counter()
+            sampler.start()
+            profiler.enable()
+            try:
+                result = func(*args, **kwargs)
+                status = 'success'
+                return result
+            finally:
+                profiler.disable()
+                wall_seconds = time.perf_counter() - started
+                sampler.stop()
+                _session = None
+                try:
+                    _write_artifacts(session, target_dir, profiler, sampler, wall_seconds, status)
+                except OSError as e:
+                    logging.error(f"Failed to write profile for {session_name}: {e}")
+                finally:
+                    if started_tracemalloc:
+                        tracemalloc.stop()
+
+        return wrapper
+    return decorator
@@ -6,10 +6,13 @@ Triggers less frequently to avoid DB contention
 from airflow import DAG
 from airflow.operators.bash import BashOperator
 from airflow.operators.python import PythonOperator
+from airflow.models import Variable
 from datetime import datetime, timedelta
-import psycopg2
+from common.db import transaction
+from common.profiling import phase, profiled
 import csv
 import os
+import hashlib
 import logging
 import shutil
 
@@ -31,54 +34,83 @@ dag = DAG(
     tags=['transformation', 'export'],
 )
 
+# dbt paths inside the dota2_dbt container
+DBT_PROJECT_DIR = '/dbt/hybrid_engineer'
+DBT_PROFILES_DIR = '/root/.dbt'
+# Manifest of the last successful build, used for state:modified+ selection
+DBT_STATE_DIR = f'{DBT_PROJECT_DIR}/state'
+
+# dbt selectors for each upstream source, plus models whose code changed
+BRONZE_SELECTOR = 'source:bronze+'
+DIMS_SELECTOR = 'source:dota+'
+MODIFIED_SELECTOR = 'state:modified+'
+
+DIM_TABLES = ['dim_heroes', 'dim_game_modes', 'dim_lobby_types']
+
+def get_dims_fingerprint(cursor):
+    """Hash the content of all dimension tables (they are small)"""
+    digest = hashlib.md5()
+    for table in DIM_TABLES:
+        cursor.execute(f"""
+            SELECT md5(COALESCE(string_agg(t::text, '|' ORDER BY t.id), ''))
+            FROM dota.{table} t
+        """)
+        digest.update(f"{table}:{cursor.fetchone()[0]};".encode())
+    return digest.hexdigest()
+
 # Check if there's new data to transform
 def check_new_data(**context):
-    """Check if we have untransformed data"""
-    conn = psycopg2.connect(
-        host='postgres',
-        database='airflow',
-        user='airflow',
-        password='airflow'
-    )
-    cursor = conn.cursor()
-    
-    # Count bronze vs silver matches
-    cursor.execute("SELECT COUNT(*) FROM bronze.matches")
-    bronze_count = cursor.fetchone()[0]
-    
-    # Check if silver.silver_matches table exists
-    cursor.execute("""
-        SELECT EXISTS (
-            SELECT FROM information_schema.tables 
-            WHERE table_schema = 'silver' 
-            AND table_name = 'silver_matches'
-        )
-    """)
-    table_exists = cursor.fetchone()[0]
+    """Check which sources changed and push the dbt selection to XCom"""
+    with transaction() as cursor:
+        # Fingerprint dims so a metadata refresh alone still rebuilds gold
+        dims_fingerprint = get_dims_fingerprint(cursor)
+        context['ti'].xcom_push(key='dims_fingerprint', value=dims_fingerprint)
+        
+        # Count bronze vs silver matches
+        cursor.execute("SELECT COUNT(*) FROM bronze.matches")
+        bronze_count = cursor.fetchone()[0]
+        
+        # Check if silver.silver_matches table exists
+        cursor.execute("""
+            SELECT EXISTS (
+                SELECT FROM information_schema.tables 
+                WHERE table_schema = 'silver' 
+                AND table_name = 'silver_matches'
+            )
+        """)
+        table_exists = cursor.fetchone()[0]
+        
+        # Table exists, count records
+        if table_exists:
+            cursor.execute("SELECT COUNT(*) FROM silver.silver_matches")
+            silver_count = cursor.fetchone()[0]
     
     if not table_exists:
         # First time run - silver tables don't exist yet
         logging.info(f"Silver tables don't exist yet. Bronze has {bronze_count} matches. Running dbt for first time...")
-        cursor.close()
-        conn.close()
+        # Empty selection = full build
+        context['ti'].xcom_push(key='dbt_select', value='')
         return bronze_count
     
-    # Table exists, count records
-    cursor.execute("SELECT COUNT(*) FROM silver.silver_matches")
-    silver_count = cursor.fetchone()[0]
-    
-    cursor.close()
-    conn.close()
-    
     new_data_count = bronze_count - silver_count
-    
-    logging.info(f"Bronze: {bronze_count}, Silver: {silver_count}, New: {new_data_count}")
-    
-    if new_data_count <= 0:
-        logging.info("No new data to transform, skipping")
-        raise ValueError("No new data")
-    
-    logging.info(f"Found {new_data_count} new matches to transform")
+    dims_changed = dims_fingerprint != Variable.get('dims_fingerprint', default_var=None)
+    
+    logging.info(f"Bronze: {bronze_count}, Silver: {silver_count}, New: {new_data_count}, Dims changed: {dims_changed}")
+    
+    # Always include modified models, so code changes are built even
+    # when no new data arrived (dbt then builds nothing if none changed)
+    selectors = [MODIFIED_SELECTOR]
+    if new_data_count > 0:
+        selectors.append(BRONZE_SELECTOR)
+    if dims_changed:
+        selectors.append(DIMS_SELECTOR)
+    
+    if len(selectors) == 1:
+        logging.info("No new data to transform, building modified models only")
+    else:
+        logging.info(f"Found {new_data_count} new matches to transform")
+    logging.info(f"Selecting: {' '.join(selectors)}")
+    context['ti'].xcom_push(key='dbt_select', value=' '.join(selectors))
     return new_data_count
 
 check_data = PythonOperator(
@@ -87,21 +119,58 @@ check_data = PythonOperator(
     dag=dag,
 )
 
-# dbt run
-dbt_run = BashOperator(
-    task_id='dbt_run',
-    bash_command='docker exec dota2_dbt dbt run --project-dir /dbt/hybrid_engineer --profiles-dir /root/.dbt',
+# dbt build (run + test in one invocation, one parse)
+# - Selects only what changed downstream of bronze/dims, plus state:modified+
+#   against the manifest of the last successful build (code changes)
+# - Without a saved manifest (first run after deploy) it falls back to a full build
+# - target/ is kept between runs so dbt reuses partial_parse.msgpack
+# - Demo models under models/example/ are never built
+# - Threads come from the Airflow Variable 'dbt_threads'
+DBT_BUILD_COMMAND = """
+docker exec \\
+    -e DBT_SELECT="{{ ti.xcom_pull(task_ids='check_new_data', key='dbt_select') }}" \\
+    -e DBT_THREADS="{{ var.value.get('dbt_threads', '2') }}" \\
+    dota2_dbt sh -c '
+set -e
+cd """ + DBT_PROJECT_DIR + """
+STATE_ARGS=""
+if [ -f """ + DBT_STATE_DIR + """/manifest.json ]; then
+    STATE_ARGS="--state """ + DBT_STATE_DIR + """"
+else
+    DBT_SELECT=""
+fi
+SELECT_ARGS=""
+if [ -n "$DBT_SELECT" ]; then
+    SELECT_ARGS="--select $DBT_SELECT"
+fi
+dbt build --profiles-dir """ + DBT_PROFILES_DIR + """ --partial-parse \\
+    $SELECT_ARGS --exclude path:models/example $STATE_ARGS --threads "$DBT_THREADS"
+mkdir -p """ + DBT_STATE_DIR + """
+cp target/manifest.json """ + DBT_STATE_DIR + """/manifest.json
+'
+"""
+
+dbt_build = BashOperator(
+    task_id='dbt_build',
+    bash_command=DBT_BUILD_COMMAND,
     dag=dag,
 )
 
-# dbt test
-dbt_test = BashOperator(
-    task_id='dbt_test',
-    bash_command='docker exec dota2_dbt dbt test --project-dir /dbt/hybrid_engineer --profiles-dir /root/.dbt',
+# Remember which dims were built, only after dbt succeeded
+def save_dims_fingerprint(**context):
+    """Persist the dims fingerprint used by the successful build"""
+    dims_fingerprint = context['ti'].xcom_pull(task_ids='check_new_data', key='dims_fingerprint')
+    Variable.set('dims_fingerprint', dims_fingerprint)
+    logging.info(f"Saved dims fingerprint: {dims_fingerprint}")
+
+save_state = PythonOperator(
+    task_id='save_dims_fingerprint',
+    python_callable=save_dims_fingerprint,
     dag=dag,
 )
 
 # Export to CSV
+@profiled()
 def export_to_csv(**context):
     """Export gold tables to CSV"""
     
@@ -111,47 +180,41 @@ def export_to_csv(**context):
     os.makedirs(export_dir, exist_ok=True)
     os.makedirs(onedrive_dir, exist_ok=True)
     
-    conn = psycopg2.connect(
-        host='postgres',
-        database='airflow',
-        user='airflow',
-        password='airflow'
-    )
-    cursor = conn.cursor()
-    
     tables = [
         ('gold', 'gold_match_analytics'),
         ('gold', 'gold_player_stats'),
     ]
     
-    for schema, table in tables:
-        try:
-            logging.info(f"Exporting {schema}.{table}...")
-            
-            cursor.execute(f'SELECT * FROM {schema}.{table}')
-            rows = cursor.fetchall()
-            columns = [desc[0] for desc in cursor.description]
-            
-            csv_filename = f'{table}.csv'
-            csv_path = os.path.join(export_dir, csv_filename)
-            
-            with open(csv_path, 'w', newline='', encoding='utf-8') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(columns)
-                writer.writerows(rows)
-            
-            # Copy to OneDrive
-            onedrive_path = os.path.join(onedrive_dir, csv_filename)
-            shutil.copy2(csv_path, onedrive_path)
-            
-            logging.info(f"✓ Exported {len(rows)} rows to {csv_filename}")
-            
-        except Exception as e:
-            logging.error(f"Error exporting {schema}.{table}: {e}")
-            raise
-    
-    cursor.close()
-    conn.close()
+    with transaction() as cursor:
+        for schema, table in tables:
+            try:
+                logging.info(f"Exporting {schema}.{table}...")
+                
+                # Client-side cursor: execute() already transfers all rows,
+                # so query + transfer are one phase
+                with phase('db_fetch'):
+                    cursor.execute(f'SELECT * FROM {schema}.{table}')
+                    rows = cursor.fetchall()
+                columns = [desc[0] for desc in cursor.description]
+                
+                csv_filename = f'{table}.csv'
+                csv_path = os.path.join(export_dir, csv_filename)
+                
+                with phase('write_csv'), open(csv_path, 'w', newline='', encoding='utf-8') as csvfile:
+                    writer = csv.writer(csvfile)
+                    writer.writerow(columns)
+                    writer.writerows(rows)
+                
+                # Copy to OneDrive
+                onedrive_path = os.path.join(onedrive_dir, csv_filename)
+                with phase('copy_onedrive'):
+                    shutil.copy2(csv_path, onedrive_path)
+                
+                logging.info(f"✓ Exported {len(rows)} rows to {csv_filename}")
+                
+            except Exception as e:
+                logging.error(f"Error exporting {schema}.{table}: {e}")
+                raise
     
     logging.info("✅ Export complete!")
 
@@ -162,4 +225,4 @@ export_task = PythonOperator(
 )
 
 # Task dependencies
-check_data >> dbt_run >> dbt_test >> export_task
+check_data >> dbt_build >> save_state >> export_task
@@ -2,7 +2,8 @@ import duckdb
 import json
 import os
 
-conn = duckdb.connect('/dbt/omniverse.duckdb')
+# common/ is mounted from dags/common (see docker-compose, PYTHONPATH=/opt/pipeline)
+from common.profiling import phase, profiled
 
 tables_to_export = [
     'silver_dota2_matches',
@@ -10,36 +11,46 @@ tables_to_export = [
     'gold_match_analytics'
 ]
 
-export_summary = []
+# Profile: docker exec -e PIPELINE_PROFILING=true dota2_dbt python /dbt/export_to_parquet.py
+@profiled(name='export_to_parquet', output_dir='/dbt/profiles')
+def main():
+    conn = duckdb.connect('/dbt/omniverse.duckdb')
+    
+    export_summary = []
+    
+    for table in tables_to_export:
+        try:
+            with phase('count'):
+                count = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            output_path = f'/dbt/{table}.parquet'
+            with phase('copy_parquet'):
+                conn.execute(f'COPY {table} TO "{output_path}" (FORMAT PARQUET)')
+            size_bytes = os.path.getsize(output_path)
+            size_mb = round(size_bytes / (1024 * 1024), 2)
+            
+            export_summary.append({
+                'table': table,
+                'rows': count,
+                'size_mb': size_mb,
+                'file': f'{table}.parquet',
+                'status': 'SUCCESS'
+            })
+            
+            print(f'✅ Exported {table}: {count} rows, {size_mb} MB')
+            
+        except Exception as e:
+            export_summary.append({
+                'table': table,
+                'status': 'FAILED',
+                'error': str(e)
+            })
+            print(f'❌ Failed {table}: {e}')
+    
+    with open('/dbt/export_manifest.json', 'w') as f:
+        json.dump(export_summary, f, indent=2)
+    
+    print('\n📊 Export Summary:')
+    print(json.dumps(export_summary, indent=2))
 
-for table in tables_to_export:
-    try:
-        count = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
-        output_path = f'/dbt/{table}.parquet'
-        conn.execute(f'COPY {table} TO "{output_path}" (FORMAT PARQUET)')
-        size_bytes = os.path.getsize(output_path)
-        size_mb = round(size_bytes / (1024 * 1024), 2)
-        
-        export_summary.append({
-            'table': table,
-            'rows': count,
-            'size_mb': size_mb,
-            'file': f'{table}.parquet',
-            'status': 'SUCCESS'
-        })
-        
-        print(f'✅ Exported {table}: {count} rows, {size_mb} MB')
-        
-    except Exception as e:
-        export_summary.append({
-            'table': table,
-            'status': 'FAILED',
-            'error': str(e)
-        })
-        print(f'❌ Failed {table}: {e}')
-
-with open('/dbt/export_manifest.json', 'w') as f:
-    json.dump(export_summary, f, indent=2)
-
-print('\n📊 Export Summary:')
-print(json.dumps(export_summary, indent=2))
+if __name__ == '__main__':
+    main()
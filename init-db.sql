@@ -8,6 +8,9 @@ CREATE SCHEMA IF NOT EXISTS gold;
 -- Create schema for static metadata
 CREATE SCHEMA IF NOT EXISTS dota;
 
+-- Create schema for pipeline bookkeeping
+CREATE SCHEMA IF NOT EXISTS ops;
+
 -- Bronze: Raw data from API
 CREATE TABLE IF NOT EXISTS bronze.matches (
     match_id BIGINT PRIMARY KEY,
@@ -46,13 +49,30 @@ CREATE TABLE IF NOT EXISTS dota.dim_lobby_types (
     name VARCHAR(255)
 );
 
+-- Ops: OpenDota request budget shared by all DAGs (see dags/common/opendota.py)
+CREATE TABLE IF NOT EXISTS ops.api_quota (
+    name VARCHAR(64) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    capacity DOUBLE PRECISION NOT NULL,
+    refill_per_sec DOUBLE PRECISION NOT NULL,
+    blocked_until TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+);
+
+-- Defaults match OPENDOTA_BURST=5, OPENDOTA_REQUESTS_PER_MINUTE=60 (the DAGs re-apply the env config)
+INSERT INTO ops.api_quota (name, tokens, capacity, refill_per_sec)
+VALUES ('opendota', 5, 5, 1.0)
+ON CONFLICT (name) DO NOTHING;
+
 -- Grant permissions
 GRANT ALL PRIVILEGES ON SCHEMA bronze TO airflow;
 GRANT ALL PRIVILEGES ON SCHEMA silver TO airflow;
 GRANT ALL PRIVILEGES ON SCHEMA gold TO airflow;
 GRANT ALL PRIVILEGES ON SCHEMA dota TO airflow;
+GRANT ALL PRIVILEGES ON SCHEMA ops TO airflow;
 
 GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA bronze TO airflow;
 GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA silver TO airflow;
 GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA gold TO airflow;
 GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA dota TO airflow;
+GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA ops TO airflow;